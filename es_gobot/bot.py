@@ -1,19 +1,30 @@
 import os
 import time
+import secrets
 import random
 import asyncio
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import logging
+import asyncpg
+from functools import wraps
+from itertools import groupby
+from collections import OrderedDict
+from telegram import Update, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    AIORateLimiter,
     CommandHandler,
     ContextTypes,
     ChatMemberHandler,
+    filters,
 )
-from telegram.error import Forbidden, TimedOut, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, TimedOut, NetworkError, RetryAfter, TelegramError
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # ================= CONFIG =================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -24,6 +35,40 @@ LINK_EXPIRE = 15
 LINK_COOLDOWN = 1800
 LINK_GRACE = 10
 LINK_LOCK_SECONDS = 3
+# запас заранее созданных ссылок: /link отдаёт готовую без запроса к Telegram
+INVITE_POOL_SIZE = 5
+INVITE_POOL_TTL = 600
+INVITE_POOL_RETRY = 5
+
+TG_POOL_SIZE = 256
+TG_POOL_TIMEOUT = 30
+TG_CONNECT_TIMEOUT = 5
+TG_READ_TIMEOUT = 20
+# getUpdates — один долгий запрос за раз, большой пул ему не нужен
+TG_UPDATES_POOL_SIZE = 4
+TG_POLL_TIMEOUT = 50
+
+# лимит Telegram — около 30 сообщений в секунду на бота, держимся чуть ниже
+SEND_RATE = 28
+SEND_RETRIES = 5
+BROADCAST_CONCURRENCY = 50
+BROADCAST_QUEUE_SIZE = 2000
+BROADCAST_FETCH_SIZE = 1000
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "10"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "32"))
+# простаивающие соединения закрываются раньше, чем их оборвёт NAT
+DB_POOL_IDLE_LIFETIME = 300
+# зависший запрос не должен держать соединение пула бесконечно
+DB_COMMAND_TIMEOUT = 60
+
+# webhook включается, когда известен публичный адрес; без него — polling (локально).
+# входящий HTTP получает только Railway: процесс worker из Procfile на Heroku-подобных
+# хостингах снаружи недоступен, там WEBHOOK_HOST задавать нельзя
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST") or os.getenv("RAILWAY_PUBLIC_DOMAIN")
+PORT = int(os.getenv("PORT", "8080"))
+# Telegram присылает его в заголовке каждого апдейта; чужие запросы на url_path отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_hex(32)
 
 WELCOME_IMAGE = "https://image2url.com/r2/default/images/1769954121038-a6517e21-52cd-4d74-86c1-6b8b8fcfb5d3.jpg"
 
@@ -33,121 +78,242 @@ if not BOT_TOKEN or not DATABASE_URL:
 if ADMIN_ID == 0:
     print("⚠️ ADMIN_ID не задан")
 
+logger = logging.getLogger(__name__)
+
 DB_POOL = None
+SWEEPER_TASK = None
+WRITER_TASK = None
+INVITE_TASK = None
+
+# таблицы списков, которыми управляет админ: таблица -> колонка
+LIST_TABLES = {
+    "bots": "username",
+    "sites": "url",
+    "price_channels": "url",
+    "contact_channels": "url",
+    "job_channels": "url",
+}
+
+LIST_ICONS = {
+    "bots": "🟢",
+    "sites": "🔗",
+    "price_channels": "💰",
+    "contact_channels": "📞",
+    "job_channels": "💼",
+}
+
+# все списки одним запросом: kind = имя таблицы
+LISTS_SQL = " UNION ALL ".join(
+    f"SELECT '{table}' AS kind, {column} AS v FROM {table}"
+    for table, column in LIST_TABLES.items()
+)
+
+# горячие запросы: один и тот же текст SQL попадает в кэш подготовленных
+# выражений asyncpg на каждом соединении, значения передаются только параметрами
+USER_INSERT_SQL = """
+    INSERT INTO users (user_id, username, first_name, last_name, first_used)
+    VALUES ($1,$2,$3,$4,NOW())
+    ON CONFLICT (user_id) DO NOTHING
+"""
+
+# проверка кулдауна и его фиксация одним атомарным запросом
+LINK_CLAIM_SQL = """
+    WITH prev AS (
+        SELECT timestamp FROM last_requests WHERE user_id=$1
+    ), ins AS (
+        INSERT INTO last_requests(user_id, timestamp)
+        VALUES ($1,$2)
+        ON CONFLICT (user_id) DO UPDATE SET timestamp=EXCLUDED.timestamp
+        WHERE last_requests.timestamp <= $2 - $3
+        RETURNING 1
+    )
+    SELECT (SELECT timestamp FROM prev) AS last, EXISTS (SELECT 1 FROM ins) AS ok
+"""
+
+ACTIVE_LINK_UPSERT_SQL = """
+    INSERT INTO active_links(user_id, invite_link, expire)
+    VALUES ($1,$2,$3)
+    ON CONFLICT (user_id) DO UPDATE
+    SET invite_link=EXCLUDED.invite_link, expire=EXCLUDED.expire
+"""
+
+CACHE_TTL = 60
+SWEEP_INTERVAL = 60
+WRITE_QUEUE_SIZE = 1024
+WRITE_BATCH_SIZE = 200
+SEEN_USERS_MAX = 50_000
 
 # ================= DATABASE =================
-def get_db():
-    return DB_POOL.getconn()
+async def init_db():
+    await DB_POOL.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS bots (
+            username TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS sites (
+            url TEXT PRIMARY KEY
+        );
+        CREATE UNLOGGED TABLE IF NOT EXISTS active_links (
+            user_id BIGINT PRIMARY KEY,
+            invite_link TEXT,
+            expire BIGINT
+        );
+        CREATE UNLOGGED TABLE IF NOT EXISTS last_requests (
+            user_id BIGINT PRIMARY KEY,
+            timestamp BIGINT
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            first_used TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS price_channels (
+            url TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS contact_channels (
+            url TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS job_channels (
+            url TEXT PRIMARY KEY
+        );
+
+        -- миграция старых схем: user_id хранился как TEXT, время — как INTEGER/TIMESTAMP.
+        -- first_used писался через datetime.utcnow() без пояса: трактуем его как UTC,
+        -- а не как TimeZone текущей сессии
+        DO $$
+        DECLARE m RECORD;
+        BEGIN
+            FOR m IN SELECT * FROM (VALUES
+                ('users', 'user_id', 'bigint', NULL),
+                ('active_links', 'user_id', 'bigint', NULL),
+                ('last_requests', 'user_id', 'bigint', NULL),
+                ('active_links', 'expire', 'bigint', NULL),
+                ('last_requests', 'timestamp', 'bigint', NULL),
+                ('users', 'first_used', 'timestamp with time zone',
+                 'first_used::timestamp AT TIME ZONE ''UTC''')
+            ) AS t(tbl, col, typ, using_expr) LOOP
+                IF (
+                    SELECT data_type FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = m.tbl AND column_name = m.col
+                ) <> m.typ THEN
+                    EXECUTE format(
+                        'ALTER TABLE %I ALTER COLUMN %I TYPE %s USING %s',
+                        m.tbl, m.col, m.typ,
+                        coalesce(m.using_expr, format('%I::%s', m.col, m.typ))
+                    );
+                END IF;
+            END LOOP;
+        END $$;
+
+        -- ссылки и кулдауны эфемерны, WAL для них не нужен
+        DO $$
+        DECLARE t TEXT;
+        BEGIN
+            FOREACH t IN ARRAY ARRAY['active_links', 'last_requests'] LOOP
+                IF (SELECT relpersistence FROM pg_class WHERE oid = to_regclass(t)) = 'p' THEN
+                    EXECUTE format('ALTER TABLE %I SET UNLOGGED', t);
+                END IF;
+            END LOOP;
+        END $$;
+
+        CREATE INDEX IF NOT EXISTS active_links_expire_idx ON active_links(expire);
+        CREATE INDEX IF NOT EXISTS last_requests_timestamp_idx ON last_requests(timestamp);
+
+        -- блокировки /link теперь живут в памяти процесса
+        DROP TABLE IF EXISTS link_locks;
+    """)
+
+# settings меняются только через set_setting, поэтому держим их в памяти целиком
+_settings_cache = {}
+
+async def load_settings():
+    rows = await DB_POOL.fetch("SELECT key, value FROM settings")
+    _settings_cache.clear()
+    _settings_cache.update({r["key"]: r["value"] for r in rows})
+
+async def get_setting(key):
+    return _settings_cache.get(key)
+
+async def set_setting(key, value):
+    await DB_POOL.execute(
+        "INSERT INTO settings (key,value) VALUES ($1,$2) "
+        "ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value",
+        key, str(value)
+    )
+    _settings_cache[key] = str(value)
 
-def release_db(conn):
-    DB_POOL.putconn(conn)
+# ================= CACHE =================
+# значения живут CACHE_TTL секунд; админские команды сбрасывают их сразу
+_MISS = object()
+_cache = {}
 
-def init_db():
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                );
-                CREATE TABLE IF NOT EXISTS bots (
-                    username TEXT PRIMARY KEY
-                );
-                CREATE TABLE IF NOT EXISTS sites (
-                    url TEXT PRIMARY KEY
-                );
-                CREATE TABLE IF NOT EXISTS active_links (
-                    user_id TEXT PRIMARY KEY,
-                    invite_link TEXT,
-                    expire INTEGER
-                );
-                CREATE TABLE IF NOT EXISTS last_requests (
-                    user_id TEXT PRIMARY KEY,
-                    timestamp INTEGER
-                );
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id TEXT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    first_used TIMESTAMP
-                );
-                CREATE TABLE IF NOT EXISTS link_locks (
-                    user_id TEXT PRIMARY KEY,
-                    timestamp INTEGER
-                );
-                CREATE TABLE IF NOT EXISTS price_channels (
-                    url TEXT PRIMARY KEY
-                );
-                CREATE TABLE IF NOT EXISTS contact_channels (
-                    url TEXT PRIMARY KEY
-                );
-                CREATE TABLE IF NOT EXISTS job_channels (
-                    url TEXT PRIMARY KEY
-                );
-            """)
-            db.commit()
-    finally:
-        release_db(db)
+def cache_get(key):
+    value, expire = _cache.get(key, (_MISS, 0))
+    return value if expire > time.monotonic() else _MISS
 
-def get_setting(key):
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute("SELECT value FROM settings WHERE key=%s", (key,))
-            row = cur.fetchone()
-            return row["value"] if row else None
-    finally:
-        release_db(db)
+def cache_set(key, value):
+    _cache[key] = (value, time.monotonic() + CACHE_TTL)
+    return value
 
-def set_setting(key, value):
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute(
-                "INSERT INTO settings (key,value) VALUES (%s,%s) "
-                "ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value",
-                (key, str(value))
-            )
-            db.commit()
-    finally:
-        release_db(db)
+def cache_invalidate(*keys):
+    for key in keys:
+        _cache.pop(key, None)
 
 # ================= UTILS =================
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
 
+def only_private(handler):
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.type != "private":
+            return
+        return await handler(update, context)
+    return wrapper
+
+# user_id уже записанных пользователей (LRU), чтобы не ходить в базу повторно
+_seen_users = OrderedDict()
+
 def log_user(user):
-    user_id = str(user.id)
-    username = user.username or "—"
-    first_name = user.first_name or "—"
-    last_name = user.last_name or "—"
-    now = datetime.utcnow()
+    user_id = user.id
+    if user_id in _seen_users:
+        _seen_users.move_to_end(user_id)
+        return
 
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute("SELECT 1 FROM users WHERE user_id=%s", (user_id,))
-            if cur.fetchone():
-                return
-            cur.execute("""
-                INSERT INTO users (user_id, username, first_name, last_name, first_used)
-                VALUES (%s,%s,%s,%s,%s)
-            """, (user_id, username, first_name, last_name, now))
-            db.commit()
-    finally:
-        release_db(db)
+    if not enqueue_write(
+        USER_INSERT_SQL,
+        user_id,
+        user.username or "—",
+        user.first_name or "—",
+        user.last_name or "—",
+    ):
+        return
+
+    _seen_users[user_id] = True
+    if len(_seen_users) > SEEN_USERS_MAX:
+        _seen_users.popitem(last=False)
 
 async def safe_send(func, *args, **kwargs):
-    for _ in range(3):
+    for attempt in range(SEND_RETRIES):
         try:
-            await asyncio.sleep(random.uniform(0.3, 1.2))
             return await func(*args, **kwargs)
-        except (TimedOut, NetworkError, RetryAfter):
-            await asyncio.sleep(2)
+        except RetryAfter as e:
+            delay = e.retry_after + 0.1
+        except BadRequest:
+            # подкласс NetworkError, но повтор не поможет: чат не найден, битый file_id и т.п.
+            return None
+        except (TimedOut, NetworkError):
+            delay = 2 ** attempt + random.uniform(0, 1)
         except Forbidden:
             return None
+        # после последней попытки ждать уже нечего
+        if attempt + 1 < SEND_RETRIES:
+            await asyncio.sleep(delay)
     return None
 
 def user_commands_hint():
@@ -157,221 +323,285 @@ def user_commands_hint():
         "• /info — актуальные боты, сайты и каналы 🌐"
     )
 
-# ================= LISTS =================
-def fetch_list(table):
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute(f"SELECT * FROM {table}")
-            rows = cur.fetchall()
-            return rows
-    finally:
-        release_db(db)
-
-async def get_bots_list():
-    rows = fetch_list("bots")
-    return "\n".join(f"🟢 {r['username']}" for r in rows) if rows else "—"
+# ================= TEMPLATES =================
+START_LISTS_TEMPLATE = (
+    "🤖 Актуальные боты:\n{bots}\n\n"
+    "🌐 Актуальные сайты:\n{sites}\n\n"
+    "💰 Прайс-канал:\n{price_channels}\n\n"
+    "📞 Контакт-канал:\n{contact_channels}\n\n"
+    "💼 Работа-канал:\n{job_channels}\n\n"
+)
 
-async def get_sites_list():
-    rows = fetch_list("sites")
-    return "\n".join(f"🔗 {r['url']}" for r in rows) if rows else "—"
+START_TEMPLATE = (
+    "👋 Привет, {name}!\n\n"
+    "{lists}"
+    "━━━━━━━━━━━━━━━━━━━━━━\n"
+    "🚪 **ДОСТУП В ПРИВАТНЫЙ ЧАТ**\n\n"
+    "🔑 Получи персональную ссылку:\n"
+    "1️⃣ Нажми команду /link\n"
+    "2️⃣ Ссылка активна 15 секунд ⏳\n"
+    "3️⃣ Повтор — через 30 минут ⏰\n"
+    "━━━━━━━━━━━━━━━━━━━━━━"
+)
 
-async def get_price_list():
-    rows = fetch_list("price_channels")
-    return "\n".join(f"💰 {r['url']}" for r in rows) if rows else "—"
+START_TEMPLATE_ADMIN = START_TEMPLATE + (
+    "\n\n👑 Админ:\n"
+    "• /setchat <id>\n"
+    "• /setwelcome [url]\n"
+    "• /addbot <bot>\n"
+    "• /removebot <bot>\n"
+    "• /addsite <url>\n"
+    "• /removesite <url>\n"
+    "• /addprice <url>\n"
+    "• /removeprice <url>\n"
+    "• /addcontact <url>\n"
+    "• /removecontact <url>\n"
+    "• /addjob <url>\n"
+    "• /removejob <url>\n"
+    "• /broadcast <текст>"
+)
 
-async def get_contact_list():
-    rows = fetch_list("contact_channels")
-    return "\n".join(f"📞 {r['url']}" for r in rows) if rows else "—"
+START_TEMPLATE_USER = START_TEMPLATE + user_commands_hint()
 
-async def get_job_list():
-    rows = fetch_list("job_channels")
-    return "\n".join(f"💼 {r['url']}" for r in rows) if rows else "—"
+# ================= LISTS =================
+async def fetch_all_lists():
+    lists = cache_get("lists")
+    if lists is _MISS:
+        lists = {table: [] for table in LIST_TABLES}
+        for r in await DB_POOL.fetch(LISTS_SQL):
+            lists[r["kind"]].append(r["v"])
+        cache_set("lists", lists)
+    return lists
+
+async def get_lists():
+    rendered = cache_get("rendered_lists")
+    if rendered is _MISS:
+        lists = await fetch_all_lists()
+        rendered = cache_set("rendered_lists", {
+            table: "\n".join(f"{LIST_ICONS[table]} {v}" for v in values) if values else "—"
+            for table, values in lists.items()
+        })
+    return rendered
+
+async def render_lists_block():
+    block = cache_get("start_lists")
+    if block is _MISS:
+        block = cache_set("start_lists", START_LISTS_TEMPLATE.format_map(await get_lists()))
+    return block
+
+def invalidate_lists():
+    cache_invalidate("lists", "rendered_lists", "start_lists")
+
+async def refresh_lists():
+    invalidate_lists()
+    await render_lists_block()
 
 # ================= COMMANDS =================
+@only_private
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != "private":
-        return
-
     user = update.effective_user
     log_user(user)
 
-    bots_list = await get_bots_list()
-    sites_list = await get_sites_list()
-    price_list = await get_price_list()
-    contact_list = await get_contact_list()
-    job_list = await get_job_list()
-
-    caption = (
-        f"👋 Привет, {user.first_name or 'друг'}!\n\n"
-        f"🤖 Актуальные боты:\n{bots_list}\n\n"
-        f"🌐 Актуальные сайты:\n{sites_list}\n\n"
-        f"💰 Прайс-канал:\n{price_list}\n\n"
-        f"📞 Контакт-канал:\n{contact_list}\n\n"
-        f"💼 Работа-канал:\n{job_list}\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━\n"
-        "🚪 **ДОСТУП В ПРИВАТНЫЙ ЧАТ**\n\n"
-        "🔑 Получи персональную ссылку:\n"
-        "1️⃣ Нажми команду /link\n"
-        "2️⃣ Ссылка активна 15 секунд ⏳\n"
-        "3️⃣ Повтор — через 30 минут ⏰\n"
-        "━━━━━━━━━━━━━━━━━━━━━━"
+    template = START_TEMPLATE_ADMIN if is_admin(user.id) else START_TEMPLATE_USER
+    caption = template.format(
+        name=user.first_name or "друг",
+        lists=await render_lists_block()
     )
 
-    if is_admin(user.id):
-        caption += (
-            "\n\n👑 Админ:\n"
-            "• /setchat <id>\n"
-            "• /addbot <bot>\n"
-            "• /removebot <bot>\n"
-            "• /addsite <url>\n"
-            "• /removesite <url>\n"
-            "• /addprice <url>\n"
-            "• /removeprice <url>\n"
-            "• /addcontact <url>\n"
-            "• /removecontact <url>\n"
-            "• /addjob <url>\n"
-            "• /removejob <url>\n"
-            "• /broadcast <текст>"
+    # после первой отправки Telegram отдаёт file_id — дальше шлём его, а не URL.
+    # если file_id или картинка из /setwelcome перестали работать — пробуем следующий источник
+    file_id = await get_setting("welcome_file_id")
+    sources = (file_id, await get_setting("welcome_image"), WELCOME_IMAGE)
+    for photo in dict.fromkeys(p for p in sources if p):
+        msg = await safe_send(
+            context.bot.send_photo,
+            chat_id=update.effective_chat.id,
+            photo=photo,
+            caption=caption
         )
-    else:
-        caption += user_commands_hint()
+        if msg:
+            break
+        logger.warning("Не удалось отправить приветственную картинку %s", photo)
+        if photo == file_id:
+            file_id = None
+            await set_setting("welcome_file_id", "")
 
-    await safe_send(
-        context.bot.send_photo,
-        chat_id=update.effective_chat.id,
-        photo=WELCOME_IMAGE,
-        caption=caption
-    )
+    if not file_id and msg and msg.photo:
+        await set_setting("welcome_file_id", msg.photo[-1].file_id)
 
 # ========================= /link =========================
+# пользователи, для которых ссылка создаётся прямо сейчас (защита от двойного нажатия):
+# user_id -> получил ли уже ответ на повторное нажатие
+_link_in_progress = {}
+
+# token bucket на /link: не чаще одного запроса в LINK_LOCK_SECONDS, без похода в базу
+_link_buckets = {}
+
+def take_link_token(user_id: int) -> bool:
+    now = time.monotonic()
+    tokens, last = _link_buckets.get(user_id, (1.0, now))
+    tokens = min(1.0, tokens + (now - last) / LINK_LOCK_SECONDS)
+    if tokens < 1:
+        _link_buckets[user_id] = (tokens, now)
+        return False
+    _link_buckets[user_id] = (tokens - 1, now)
+    return True
+
 async def link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private":
         return await safe_send(update.message.reply_text, "❌ Команда доступна только в ЛС.")
 
     user = update.effective_user
-    user_id = str(user.id)
-    log_user(user)
+    user_id = user.id
 
-    now = int(time.time())
-    db = get_db()
+    # на повторные нажатия отвечаем один раз за попытку, чтобы ответы не стали флудом
+    if user_id in _link_in_progress:
+        if not _link_in_progress[user_id]:
+            _link_in_progress[user_id] = True
+            await safe_send(update.message.reply_text, "⏳ Ссылка уже создаётся, подождите.")
+        return
+
+    if not take_link_token(user_id):
+        return
 
+    _link_in_progress[user_id] = False
     try:
-        with db.cursor() as cur:
-            cur.execute("SELECT timestamp FROM last_requests WHERE user_id=%s", (user_id,))
-            last = cur.fetchone()
+        log_user(user)
+        await issue_link(update, context, user_id)
+    finally:
+        _link_in_progress.pop(user_id, None)
+
+# время последней выданной ссылки: запросы в кулдауне отсекаются без похода в базу
+_last_link_at = {}
+
+async def reply_cooldown(update: Update, last: int, now: int):
+    remaining = LINK_COOLDOWN - (now - last)
+    return await safe_send(
+        update.message.reply_text,
+        f"❌ Подождите {remaining // 60} мин {remaining % 60} сек."
+    )
 
-            if last and now - last["timestamp"] < LINK_COOLDOWN:
-                remaining = LINK_COOLDOWN - (now - last["timestamp"])
-                return await safe_send(
-                    update.message.reply_text,
-                    f"❌ Подождите {remaining // 60} мин {remaining % 60} сек."
-                )
+async def issue_link(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    now = int(time.time())
+
+    chat_id = await get_setting("private_chat_id")
+    if not chat_id:
+        return await safe_send(update.message.reply_text, "❌ Приватный чат не настроен.")
+
+    last = _last_link_at.get(user_id)
+    if last is not None and now - last < LINK_COOLDOWN:
+        return await reply_cooldown(update, last, now)
+
+    claim = await DB_POOL.fetchrow(LINK_CLAIM_SQL, user_id, now, LINK_COOLDOWN)
 
-            chat_id = get_setting("private_chat_id")
-            if not chat_id:
-                return await safe_send(update.message.reply_text, "❌ Приватный чат не настроен.")
+    if not claim["ok"]:
+        if claim["last"] is None:
+            # строку только что вставил параллельный запрос: кулдаун начался сейчас
+            return await reply_cooldown(update, now, now)
+        _last_link_at[user_id] = claim["last"]
+        return await reply_cooldown(update, claim["last"], now)
 
+    _last_link_at[user_id] = now
+
+    invite_link = take_pooled_invite(chat_id, now)
+    if invite_link is None:
+        try:
             invite = await context.bot.create_chat_invite_link(
                 chat_id=int(chat_id),
                 expire_date=now + LINK_EXPIRE,
                 member_limit=1
             )
+        except TelegramError:
+            # ссылка не создана — попытку не засчитываем
+            _last_link_at.pop(user_id, None)
+            await DB_POOL.execute("DELETE FROM last_requests WHERE user_id=$1 AND timestamp=$2", user_id, now)
+            raise
+        invite_link = invite.invite_link
 
-            cur.execute("""
-                INSERT INTO last_requests(user_id, timestamp)
-                VALUES (%s,%s)
-                ON CONFLICT (user_id) DO UPDATE SET timestamp=EXCLUDED.timestamp
-            """, (user_id, now))
-
-            cur.execute("""
-                INSERT INTO active_links(user_id, invite_link, expire)
-                VALUES (%s,%s,%s)
-                ON CONFLICT (user_id) DO UPDATE
-                SET invite_link=EXCLUDED.invite_link, expire=EXCLUDED.expire
-            """, (user_id, invite.invite_link, now + LINK_EXPIRE))
-
-            db.commit()
-    finally:
-        release_db(db)
+    # срок действия для входа по-прежнему LINK_EXPIRE: его проверяет protect_chat
+    await DB_POOL.execute(ACTIVE_LINK_UPSERT_SQL, user_id, invite_link, now + LINK_EXPIRE)
 
     await safe_send(
         update.message.reply_text,
         f"✅ Ссылка готова! ⏳ {LINK_EXPIRE} секунд.",
         reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🚪 Войти", url=invite.invite_link)]]
+            [[InlineKeyboardButton("🚪 Войти", url=invite_link)]]
         )
     )
 
 # ========================= info =========================
+@only_private
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != "private":
-        return
+    lists = await get_lists()
 
     await safe_send(
         update.message.reply_text,
-        f"🤖 Боты:\n{await get_bots_list()}\n\n"
-        f"🌐 Сайты:\n{await get_sites_list()}\n\n"
-        f"💰 Прайс-канал:\n{await get_price_list()}\n\n"
-        f"📞 Контакт-канал:\n{await get_contact_list()}\n\n"
-        f"💼 Работа-канал:\n{await get_job_list()}"
+        f"🤖 Боты:\n{lists['bots']}\n\n"
+        f"🌐 Сайты:\n{lists['sites']}\n\n"
+        f"💰 Прайс-канал:\n{lists['price_channels']}\n\n"
+        f"📞 Контакт-канал:\n{lists['contact_channels']}\n\n"
+        f"💼 Работа-канал:\n{lists['job_channels']}"
     )
 
 # ================= ADMIN ADD/REMOVE =================
-def add_remove_handler(command, table, column):
+def add_remove_handler(command, table):
+    if table not in LIST_TABLES:
+        raise ValueError(f"Недопустимая таблица: {table}")
+
+    column = LIST_TABLES[table]
+    if command.startswith("add"):
+        sql = f"INSERT INTO {table} ({column}) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING"
+    else:
+        sql = f"DELETE FROM {table} WHERE {column} = ANY($1::text[])"
+
+    @only_private
     async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if update.effective_chat.type != "private":
-            return
-        if not is_admin(update.effective_user.id):
-            return
         if not context.args:
             return await safe_send(update.message.reply_text, f"❌ Укажите значение для {command}")
 
-        value = context.args[0]
-        db = get_db()
-
-        try:
-            with db.cursor() as cur:
-                if command.startswith("add"):
-                    cur.execute(
-                        f"INSERT INTO {table} ({column}) VALUES (%s) ON CONFLICT DO NOTHING",
-                        (value,)
-                    )
-                else:
-                    cur.execute(f"DELETE FROM {table} WHERE {column}=%s", (value,))
-                db.commit()
-        finally:
-            release_db(db)
+        values = list(context.args)
+        await DB_POOL.execute(sql, values)
+        await refresh_lists()
 
-        await safe_send(update.message.reply_text, f"✅ {command} выполнен: {value}")
+        await safe_send(update.message.reply_text, f"✅ {command} выполнен: {', '.join(values)}")
 
     return handler
 
 # ========================= ИСПРАВЛЕННЫЙ /setchat =========================
+@only_private
 async def setchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != "private":
-        return
-
-    if not is_admin(update.effective_user.id):
-        return
-
     if not context.args:
         return await safe_send(update.message.reply_text, "❌ Укажите ID чата")
 
     chat_id = context.args[0]
-    set_setting("private_chat_id", chat_id)
+    try:
+        int(chat_id)
+    except ValueError:
+        return await safe_send(update.message.reply_text, "❌ ID чата должен быть числом")
+
+    await set_setting("private_chat_id", chat_id)
+    reset_invite_pool()
 
     await safe_send(
         update.message.reply_text,
         f"✅ Приватный чат установлен: {chat_id}"
     )
 
+# ========================= /setwelcome =========================
+@only_private
+async def setwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        await set_setting("welcome_image", context.args[0])
+    await set_setting("welcome_file_id", "")
+
+    await safe_send(
+        update.message.reply_text,
+        "✅ Приветственная картинка обновится при следующем /start"
+    )
+
 # ========================= BROADCAST =========================
+@only_private
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != "private":
-        return
-    if not is_admin(update.effective_user.id):
-        return
     if not context.args:
         return await safe_send(update.message.reply_text, "❌ Укажите текст")
 
@@ -379,22 +609,40 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_send(update.message.reply_text, "📤 Рассылка запущена...")
 
     async def _send_messages():
-        db = get_db()
+        queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
+        sent, failed = 0, 0
+
+        async def _worker():
+            nonlocal sent, failed
+            while (user_id := await queue.get()) is not None:
+                try:
+                    ok = await safe_send(context.bot.send_message, user_id, text) is not None
+                except Exception:
+                    # воркер не должен умирать: иначе производитель повиснет на полной очереди
+                    logger.exception("Ошибка рассылки для %s", user_id)
+                    ok = False
+                if ok:
+                    sent += 1
+                else:
+                    failed += 1
+
+        workers = [asyncio.create_task(_worker()) for _ in range(BROADCAST_CONCURRENCY)]
+
+        # пользователи читаются страницами по ключу короткими запросами:
+        # соединение не держится открытой транзакцией всю (долгую) рассылку
         try:
-            with db.cursor() as cur:
-                cur.execute("SELECT user_id FROM users")
-                rows = cur.fetchall()
+            last_id = 0
+            while rows := await DB_POOL.fetch(
+                "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                last_id, BROADCAST_FETCH_SIZE
+            ):
+                for r in rows:
+                    await queue.put(r["user_id"])
+                last_id = rows[-1]["user_id"]
         finally:
-            release_db(db)
-
-        sent, failed = 0, 0
-        for r in rows:
-            try:
-                await safe_send(context.bot.send_message, int(r["user_id"]), text)
-                sent += 1
-            except:
-                failed += 1
-            await asyncio.sleep(0.05)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
 
         await safe_send(
             update.message.reply_text,
@@ -404,99 +652,335 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     asyncio.create_task(_send_messages())
 
 # ================= CHAT PROTECT =================
+async def kick(bot, chat_id: int, user_id: int):
+    # бан с немедленным разбаном: пользователь удалён, но сможет войти по новой ссылке
+    try:
+        await bot.ban_chat_member(chat_id, user_id)
+        await bot.unban_chat_member(chat_id, user_id)
+    except TelegramError:
+        logger.warning("Не удалось удалить %s из чата %s", user_id, chat_id, exc_info=True)
+
+def is_chat_member(chat_member) -> bool:
+    # как extract_status_change в PTB: restricted — участник, только пока is_member
+    if chat_member.status == ChatMember.RESTRICTED:
+        return chat_member.is_member
+    return chat_member.status in (ChatMember.MEMBER, ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
 async def protect_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     member = update.chat_member
-    if member.new_chat_member.status not in ("member", "restricted"):
+    if member.new_chat_member.status not in (ChatMember.MEMBER, ChatMember.RESTRICTED):
+        return
+    # только настоящий вход (не участник -> участник): разжалованный админ или
+    # снятие/наложение ограничений тоже приходят как member/restricted, но ссылки у них нет
+    if is_chat_member(member.old_chat_member) or not is_chat_member(member.new_chat_member):
         return
 
     user = member.new_chat_member.user
-    user_id = str(user.id)
+    user_id = user.id
     now = int(time.time())
 
     if user.is_bot:
-        try:
-            await context.bot.ban_chat_member(member.chat.id, user.id)
-            await context.bot.unban_chat_member(member.chat.id, user.id)
-        except:
-            pass
-        return
+        return await kick(context.bot, member.chat.id, user_id)
 
     invite_link_used = getattr(member.invite_link, "invite_link", None)
 
-    db = get_db()
+    # проверка и погашение ссылки одним атомарным запросом:
+    # повторный вход по той же ссылке уже не найдёт строку
+    consumed = await DB_POOL.fetchval("""
+        DELETE FROM active_links
+        WHERE user_id=$1 AND expire >= $2
+          AND ($3::text IS NULL OR invite_link=$3)
+        RETURNING 1
+    """, user_id, now - LINK_GRACE, invite_link_used)
+
+    if not consumed:
+        await kick(context.bot, member.chat.id, user_id)
+
+# ================= WRITE QUEUE =================
+# записи, результат которых не нужен пользователю, уходят в фон и не задерживают ответ
+_write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+def enqueue_write(sql, *args) -> bool:
     try:
-        with db.cursor() as cur:
-            cur.execute(
-                "SELECT invite_link, expire FROM active_links WHERE user_id=%s",
-                (user_id,)
-            )
-            row = cur.fetchone()
-    finally:
-        release_db(db)
+        _write_queue.put_nowait((sql, args))
+        return True
+    except asyncio.QueueFull:
+        logger.warning("Очередь фоновых записей переполнена, запись пропущена")
+        return False
+
+async def write_batch(batch):
+    # подряд идущие одинаковые запросы (регистрации пользователей) — одним executemany
+    for sql, group in groupby(batch, key=lambda item: item[0]):
+        rows = [args for _, args in group]
+        try:
+            if len(rows) == 1:
+                await DB_POOL.execute(sql, *rows[0])
+            else:
+                await DB_POOL.executemany(sql, rows)
+        except Exception:
+            logger.exception("Ошибка фоновой записи")
+            if sql == USER_INSERT_SQL:
+                # не записанные пользователи должны попасть в базу при следующем обращении
+                for args in rows:
+                    _seen_users.pop(args[0], None)
+
+def drain_writes(batch, limit):
+    while len(batch) < limit and not _write_queue.empty():
+        batch.append(_write_queue.get_nowait())
+    return batch
+
+async def writer():
+    # None в очереди — сигнал остановки: всё, что лежит перед ним, будет записано
+    while True:
+        batch = drain_writes([await _write_queue.get()], WRITE_BATCH_SIZE)
+        stop = None in batch
+        await write_batch([item for item in batch if item is not None])
+        if stop:
+            return
 
-    if not row or now > row["expire"] + LINK_GRACE:
+async def stop_writer():
+    await _write_queue.put(None)
+    await WRITER_TASK
+
+# ================= INVITE POOL =================
+# (chat_id, invite_link, expire_date); ссылки одноразовые, у Telegram живут INVITE_POOL_TTL.
+# пользователю обещано LINK_EXPIRE секунд: поздний вход отсекает protect_chat, а sweeper
+# отзывает выданную из запаса ссылку вместе с истёкшей строкой active_links
+_invite_pool = asyncio.Queue(maxsize=INVITE_POOL_SIZE)
+# выданные из запаса и ещё действующие у Telegram: invite_link -> элемент запаса
+_issued_invites = {}
+# ссылки на отзыв; отзывает фоновая задача, а не обработчик /link
+_invites_to_revoke = []
+# запас пополняется только по спросу: простаивающий бот Telegram не дёргает
+_invite_pool_wakeup = asyncio.Event()
+
+def invite_usable(item, chat_id: str, now: int) -> bool:
+    pooled_chat, _, expire = item
+    return pooled_chat == chat_id and expire > now + LINK_EXPIRE + LINK_GRACE
+
+def take_pooled_invite(chat_id: str, now: int):
+    _invite_pool_wakeup.set()
+    while True:
         try:
-            await context.bot.ban_chat_member(member.chat.id, user.id)
-            await context.bot.unban_chat_member(member.chat.id, user.id)
-        except:
-            pass
-        return
+            item = _invite_pool.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+        if invite_usable(item, chat_id, now):
+            _issued_invites[item[1]] = item
+            return item[1]
+        # почти истёкшие доживут не дольше обычной ссылки, отзывать стоит только чужой чат
+        if item[0] != chat_id:
+            _invites_to_revoke.append(item)
+
+def reset_invite_pool():
+    # после /setchat ссылки на старый чат отзываются, запас набирается заново
+    while not _invite_pool.empty():
+        _invites_to_revoke.append(_invite_pool.get_nowait())
+    _invite_pool_wakeup.set()
+
+def release_issued_invites(invite_links, now: int):
+    for invite_link in invite_links:
+        item = _issued_invites.pop(invite_link, None)
+        if item:
+            _invites_to_revoke.append(item)
+    # использованные (member_limit=1) и истёкшие у Telegram отзывать незачем
+    for invite_link in [l for l, (_, _, expire) in _issued_invites.items() if expire <= now]:
+        del _issued_invites[invite_link]
+    if _invites_to_revoke:
+        _invite_pool_wakeup.set()
+
+async def revoke_invites(bot, items):
+    for chat_id, invite_link, _ in items:
+        try:
+            await bot.revoke_chat_invite_link(int(chat_id), invite_link)
+        except TelegramError:
+            logger.warning("Не удалось отозвать ссылку %s", invite_link, exc_info=True)
+
+async def refill_invite_pool(bot):
+    while not _invite_pool.full():
+        chat_id = await get_setting("private_chat_id")
+        if not chat_id:
+            return
+        expire = int(time.time()) + INVITE_POOL_TTL
+        invite = await bot.create_chat_invite_link(
+            chat_id=int(chat_id),
+            expire_date=expire,
+            member_limit=1
+        )
+        _invite_pool.put_nowait((chat_id, invite.invite_link, expire))
+
+async def invite_pool_filler(app: Application):
+    while True:
+        await _invite_pool_wakeup.wait()
+        _invite_pool_wakeup.clear()
+
+        if _invites_to_revoke:
+            items = _invites_to_revoke[:]
+            _invites_to_revoke.clear()
+            await revoke_invites(app.bot, items)
 
-    if invite_link_used and invite_link_used != row["invite_link"]:
         try:
-            await context.bot.ban_chat_member(member.chat.id, user.id)
-            await context.bot.unban_chat_member(member.chat.id, user.id)
-        except:
-            pass
-        return
+            await refill_invite_pool(app.bot)
+        except (TelegramError, ValueError):
+            logger.warning("Не удалось пополнить запас ссылок", exc_info=True)
+            await asyncio.sleep(INVITE_POOL_RETRY)
+            _invite_pool_wakeup.set()
+
+# ================= SWEEPER =================
+async def sweep_expired():
+    now = int(time.time())
+    expired = await DB_POOL.fetch("""
+        WITH expired_links AS (
+            DELETE FROM active_links WHERE expire < $1 RETURNING invite_link
+        ), expired_requests AS (
+            DELETE FROM last_requests WHERE timestamp < $2
+        )
+        SELECT invite_link FROM expired_links
+    """, now - LINK_GRACE, now - LINK_COOLDOWN)
+    release_issued_invites([r["invite_link"] for r in expired], now)
 
-    db = get_db()
-    try:
-        with db.cursor() as cur:
-            cur.execute("DELETE FROM active_links WHERE user_id=%s", (user_id,))
-            db.commit()
-    finally:
-        release_db(db)
+    for user_id in [u for u, t in _last_link_at.items() if t < now - LINK_COOLDOWN]:
+        del _last_link_at[user_id]
 
-# ================= MAIN =================
-def main():
-    global DB_POOL
+    # полностью восстановившиеся корзины ничем не отличаются от отсутствующих
+    idle_since = time.monotonic() - LINK_LOCK_SECONDS
+    for user_id in [u for u, (_, last) in _link_buckets.items() if last < idle_since]:
+        del _link_buckets[user_id]
+
+async def sweeper():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            await sweep_expired()
+        except Exception:
+            logger.exception("Ошибка очистки")
 
-    DB_POOL = SimpleConnectionPool(
-        1, 20,
-        dsn=DATABASE_URL,
-        cursor_factory=RealDictCursor
+# ================= MAIN =================
+async def post_init(app: Application):
+    global DB_POOL, SWEEPER_TASK, WRITER_TASK, INVITE_TASK
+
+    # Python 3.12+: задача создаётся как обычно, но корутина начинает выполняться сразу,
+    # а не в следующей итерации цикла
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+    DB_POOL = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        max_inactive_connection_lifetime=DB_POOL_IDLE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT
     )
 
-    init_db()
+    await init_db()
+    await load_settings()
+    await refresh_lists()
+
+    SWEEPER_TASK = asyncio.create_task(sweeper())
+    WRITER_TASK = asyncio.create_task(writer())
+    INVITE_TASK = asyncio.create_task(invite_pool_filler(app))
+    # запас набирается сразу при старте
+    _invite_pool_wakeup.set()
+
+async def post_stop(app: Application):
+    # бот ещё может ходить в Telegram: ссылки из запаса и выданные, но не истёкшие,
+    # без работающего protect_chat отзываются
+    if INVITE_TASK:
+        INVITE_TASK.cancel()
+        await asyncio.gather(INVITE_TASK, return_exceptions=True)
+    reset_invite_pool()
+    await revoke_invites(app.bot, _invites_to_revoke + list(_issued_invites.values()))
+
+async def post_shutdown(app: Application):
+    tasks = [task for task in (SWEEPER_TASK, INVITE_TASK) if task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if WRITER_TASK:
+        await stop_writer()
+    if DB_POOL:
+        await DB_POOL.close()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def main():
+    # цикл на libuv быстрее стандартного; если uvloop нет — работаем на asyncio
+    if uvloop:
+        uvloop.install()
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(HTTPXRequest(
+            http_version="2",
+            connection_pool_size=TG_POOL_SIZE,
+            pool_timeout=TG_POOL_TIMEOUT,
+            connect_timeout=TG_CONNECT_TIMEOUT,
+            read_timeout=TG_READ_TIMEOUT
+        ))
+        .get_updates_request(HTTPXRequest(
+            http_version="2",
+            connection_pool_size=TG_UPDATES_POOL_SIZE,
+            pool_timeout=TG_POOL_TIMEOUT
+        ))
+        # групповой лимит Telegram (20/мин) касается сообщений, а в группу бот только
+        # создаёт ссылки и банит — иначе /link ждал бы в общей очереди с киками
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=SEND_RATE,
+            overall_time_period=1,
+            group_max_rate=0
+        ))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # USER
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("link", link))
-    app.add_handler(CommandHandler("info", info))
+    app.add_handler(CommandHandler("start", start, block=False))
+    app.add_handler(CommandHandler("link", link, block=False))
+    app.add_handler(CommandHandler("info", info, block=False))
+
+    # ADMIN: чужие команды отсекаются фильтром ещё до вызова хендлера
+    admin_only = filters.User(user_id=ADMIN_ID)
 
-    # ADMIN
-    app.add_handler(CommandHandler("setchat", setchat))
+    app.add_handler(CommandHandler("setchat", setchat, filters=admin_only, block=False))
+    app.add_handler(CommandHandler("setwelcome", setwelcome, filters=admin_only, block=False))
 
     tables = [
-        ("addbot","bots","username"), ("removebot","bots","username"),
-        ("addsite","sites","url"), ("removesite","sites","url"),
-        ("addprice","price_channels","url"), ("removeprice","price_channels","url"),
-        ("addcontact","contact_channels","url"), ("removecontact","contact_channels","url"),
-        ("addjob","job_channels","url"), ("removejob","job_channels","url"),
+        ("addbot","bots"), ("removebot","bots"),
+        ("addsite","sites"), ("removesite","sites"),
+        ("addprice","price_channels"), ("removeprice","price_channels"),
+        ("addcontact","contact_channels"), ("removecontact","contact_channels"),
+        ("addjob","job_channels"), ("removejob","job_channels"),
     ]
 
-    for cmd, table, col in tables:
-        app.add_handler(CommandHandler(cmd, add_remove_handler(cmd, table, col)))
+    for cmd, table in tables:
+        app.add_handler(CommandHandler(cmd, add_remove_handler(cmd, table), filters=admin_only, block=False))
 
-    app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("broadcast", broadcast, filters=admin_only, block=False))
 
     # CHAT PROTECT
-    app.add_handler(ChatMemberHandler(protect_chat, ChatMemberHandler.CHAT_MEMBER))
-
-    app.run_polling()
+    app.add_handler(ChatMemberHandler(protect_chat, ChatMemberHandler.CHAT_MEMBER, block=False))
+
+    # chat_member Telegram присылает только по явному запросу — без него protect_chat молчит
+    allowed_updates = [Update.MESSAGE, Update.CHAT_MEMBER]
+
+    if WEBHOOK_HOST:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"https://{WEBHOOK_HOST}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates
+        )
+    else:
+        # длинный опрос: пока апдейтов нет, запрос висит на стороне Telegram
+        app.run_polling(
+            poll_interval=0,
+            timeout=TG_POLL_TIMEOUT,
+            allowed_updates=allowed_updates
+        )
 
 if __name__ == "__main__":
     main()